@@ -6,29 +6,55 @@
 - pushes the new branch to GitHub
 """
 import argparse
+import functools
 import os
 import re
 import sys
 from pathlib import Path
-from subprocess import CalledProcessError, check_call, check_output
-from typing import Text, Set
+from subprocess import DEVNULL, CalledProcessError, call, check_call, check_output
+from typing import Any, Dict, Iterable, List, NamedTuple, Text, TYPE_CHECKING
 
-import questionary
-import toml
-from pep440_version_utils import Version, is_valid_version
+if TYPE_CHECKING:
+    from pep440_version_utils import Version
 
 
 VERSION_FILE_PATH = "rasa/version.py"
 
 PYPROJECT_FILE_PATH = "pyproject.toml"
 
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+VERSION_FILE = PROJECT_ROOT / VERSION_FILE_PATH
+
+PYPROJECT_FILE = PROJECT_ROOT / PYPROJECT_FILE_PATH
+
 REPO_BASE_URL = "https://github.com/RasaHQ/rasa"
 
 RELEASE_BRANCH_PREFIX = "prepare-release-"
 
 PRERELEASE_FLAVORS = ("alpha", "rc")
 
-RELEASE_BRANCH_PATTERN = re.compile(r"^\d+\.\d+\.x$")
+NEXT_VERSION_KEYWORDS = frozenset({"major", "minor", "micro", *PRERELEASE_FLAVORS})
+
+RELEASE_BRANCH_PATTERN = re.compile(r"\d+\.\d+\.x")
+
+# release (e.g. 2.1.0) or prerelease (e.g. 2.1.0a1, 2.1.0rc2) version number
+VERSION_NUMBER_PATTERN = re.compile(r"\d+\.\d+\.\d+(?:(?:a|rc)[1-9]\d*)?")
+
+# version number within a dependency constraint, e.g. 2.0.0 in "^2.0.0"
+DEPENDENCY_VERSION_PATTERN = re.compile(r"(\d+)\.(\d+)(?:\.\d+)?")
+
+VERSION_ASSIGNMENT_PATTERN = re.compile(rb'__version__\s*=\s*"([^"]+)"')
+
+POETRY_TABLE_HEADER_PATTERN = re.compile(r"^\[tool\.poetry\][ \t]*$", re.MULTILINE)
+
+TOML_TABLE_HEADER_PATTERN = re.compile(r"^\[", re.MULTILINE)
+
+PYPROJECT_VERSION_PATTERN = re.compile(r'^version\s*=\s*"[^"]*"', re.MULTILINE)
+
+# environment for all git subprocesses: skip taking optional locks (e.g. for
+# opportunistic index refreshes) and avoid locale dependent output
+GIT_ENV = {**os.environ, "GIT_OPTIONAL_LOCKS": "0", "LANG": "C"}
 
 
 def create_argument_parser() -> argparse.ArgumentParser:
@@ -46,72 +72,109 @@ def create_argument_parser() -> argparse.ArgumentParser:
 
 def project_root() -> Path:
     """Root directory of the project."""
-    return Path(os.path.dirname(__file__)).parent
+    return PROJECT_ROOT
 
 
 def version_file_path() -> Path:
     """Path to the python file containing the version number."""
-    return project_root() / VERSION_FILE_PATH
+    return VERSION_FILE
 
 
 def pyproject_file_path() -> Path:
     """Path to the pyproject.toml."""
-    return project_root() / PYPROJECT_FILE_PATH
+    return PYPROJECT_FILE
+
+
+@functools.lru_cache(maxsize=1)
+def load_pyproject() -> Dict[Text, Any]:
+    """Parse the pyproject.toml as it was when the release was started.
+
+    The file is only read and parsed once per run.
+    """
+    import toml
+
+    return toml.load(pyproject_file_path())
 
 
-def write_version_file(version: Version) -> None:
+def write_version_file(version: "Version") -> None:
     """Dump a new version into the python version file."""
 
-    with version_file_path().open("w") as f:
-        f.write(
-            f"# this file will automatically be changed,\n"
-            f"# do not add anything but the version number here!\n"
-            f'__version__ = "{version}"\n'
-        )
-    check_call(["git", "add", str(version_file_path().absolute())])
+    version_file_path().write_text(
+        f"# this file will automatically be changed,\n"
+        f"# do not add anything but the version number here!\n"
+        f'__version__ = "{version}"\n'
+    )
 
 
-def write_version_to_pyproject(version: Version) -> None:
-    """Dump a new version into the pyproject.toml."""
+def write_version_to_pyproject(version: "Version") -> None:
+    """Dump a new version into the pyproject.toml.
+
+    Only the version line of the `[tool.poetry]` table is replaced, the rest of the
+    file (including formatting and comments) stays untouched.
+    """
     pyproject_file = pyproject_file_path()
 
     try:
-        data = toml.load(pyproject_file)
-        data["tool"]["poetry"]["version"] = str(version)
-        with pyproject_file.open("w", encoding="utf8") as f:
-            toml.dump(data, f)
-    except (FileNotFoundError, TypeError):
+        content = pyproject_file.read_text(encoding="utf8")
+    except FileNotFoundError:
         print(f"Unable to update {pyproject_file}: file not found.")
         sys.exit(1)
-    except toml.TomlDecodeError:
-        print(f"Unable to parse {pyproject_file}: incorrect TOML file.")
+
+    section = POETRY_TABLE_HEADER_PATTERN.search(content)
+    if not section:
+        print(f"Unable to update {pyproject_file}: missing [tool.poetry] table.")
         sys.exit(1)
 
-    check_call(["git", "add", str(pyproject_file.absolute())])
+    next_table = TOML_TABLE_HEADER_PATTERN.search(content, section.end())
+    section_end = next_table.start() if next_table else len(content)
+    updated_section, replacements = PYPROJECT_VERSION_PATTERN.subn(
+        f'version = "{version}"', content[section.end() : section_end], count=1
+    )
+    if not replacements:
+        print(f"Unable to update {pyproject_file}: no version in [tool.poetry].")
+        sys.exit(1)
 
+    pyproject_file.write_text(
+        content[: section.end()] + updated_section + content[section_end:],
+        encoding="utf8",
+    )
 
+
+@functools.lru_cache(maxsize=None)
 def get_current_version() -> Text:
-    """Return the current library version."""
+    """Return the library version the release is started from.
+
+    The result is cached, so it does not reflect `write_version_file` calls.
+    """
 
     if not version_file_path().is_file():
-        raise FileNotFoundError(
-            f"Failed to find version file at {version_file_path().absolute()}"
-        )
+        raise FileNotFoundError(f"Failed to find version file at {version_file_path()}")
+
+    match = VERSION_ASSIGNMENT_PATTERN.search(version_file_path().read_bytes())
+    if not match:
+        raise ValueError(f"Failed to find a version number in {version_file_path()}")
+
+    return match.group(1).decode()
+
 
-    # context in which we evaluate the version py -
-    # to be able to access the defined version, it already needs to live in the
-    # context passed to exec
-    _globals = {"__version__": ""}
-    with version_file_path().open() as f:
-        exec(f.read(), _globals)
+def is_valid_version_number(version: Text) -> bool:
+    """Checks whether the version is a release or an alpha / rc prerelease number."""
+    return VERSION_NUMBER_PATTERN.fullmatch(version) is not None
 
-    return _globals["__version__"]
 
+@functools.lru_cache(maxsize=None)
+def get_current_parsed_version() -> "Version":
+    """Return the library version the release is started from as `Version`."""
+    from pep440_version_utils import Version
 
-def confirm_version(version: Version) -> bool:
+    return Version(get_current_version())
+
+
+def confirm_version(version: "Version") -> bool:
     """Allow the user to confirm the version number."""
+    import questionary
 
-    if str(version) in git_existing_tags():
+    if git_tag_exists(str(version)):
         confirmed = questionary.confirm(
             f"Tag with version '{version}' already exists, overwrite?", default=False
         ).ask()
@@ -130,18 +193,19 @@ def confirm_version(version: Version) -> bool:
 
 def ask_version() -> Text:
     """Allow the user to confirm the version number."""
+    import questionary
 
-    def is_valid_version_number(v: Text) -> bool:
-        return v in {"major", "minor", "micro", "alpha", "rc"} or is_valid_version(v)
+    def is_valid_version_input(v: Text) -> bool:
+        return v in NEXT_VERSION_KEYWORDS or is_valid_version_number(v)
 
-    current_version = Version(get_current_version())
+    current_version = get_current_parsed_version()
     next_micro_version = str(current_version.next_micro())
     next_alpha_version = str(current_version.next_alpha())
     version = questionary.text(
         f"What is the version number you want to release "
         f"('major', 'minor', 'micro', 'alpha', 'rc' or valid version number "
         f"e.g. '{next_micro_version}' or '{next_alpha_version}')?",
-        validate=is_valid_version_number,
+        validate=is_valid_version_input,
     ).ask()
 
     if version in PRERELEASE_FLAVORS and not current_version.pre:
@@ -170,54 +234,112 @@ def ask_version() -> Text:
         sys.exit(1)
 
 
-def get_rasa_sdk_version() -> Text:
+class RasaSdkVersion(NamedTuple):
+    """Version of the Rasa SDK referenced in the pyproject.toml."""
+
+    version: Text
+    major: int
+    minor: int
+
+
+@functools.lru_cache(maxsize=None)
+def get_rasa_sdk_version() -> RasaSdkVersion:
     """Find out what the referenced version of the Rasa SDK is."""
 
-    dependencies_filename = "pyproject.toml"
-    toml_data = toml.load(project_root() / dependencies_filename)
+    toml_data = load_pyproject()
 
     try:
-        sdk_version = toml_data["tool"]["poetry"]["dependencies"]["rasa-sdk"]
-        return sdk_version[1:].strip()
-    except AttributeError:
-        raise Exception(f"Failed to find Rasa SDK version in {dependencies_filename}")
+        dependency = toml_data["tool"]["poetry"]["dependencies"]["rasa-sdk"]
+        # either a version constraint (e.g. "^2.0.0") or a table containing one
+        if isinstance(dependency, dict):
+            dependency = dependency["version"]
+        match = DEPENDENCY_VERSION_PATTERN.search(dependency)
+    except (KeyError, TypeError):
+        match = None
+
+    if not match:
+        raise Exception(f"Failed to find Rasa SDK version in {PYPROJECT_FILE_PATH}")
+    return RasaSdkVersion(
+        version=match.group(0), major=int(match.group(1)), minor=int(match.group(2))
+    )
 
 
-def validate_code_is_release_ready(version: Version) -> None:
+def validate_code_is_release_ready(version: "Version") -> None:
     """Make sure the code base is valid (e.g. Rasa SDK is up to date)."""
 
-    sdk = Version(get_rasa_sdk_version())
+    sdk = get_rasa_sdk_version()
     sdk_version = (sdk.major, sdk.minor)
     rasa_version = (version.major, version.minor)
 
     if sdk_version != rasa_version:
         print()
         print(
-            f"\033[91m There is a mismatch between the Rasa SDK version ({sdk}) "
-            f"and the version you want to release ({version}). Before you can "
-            f"release Rasa OSS, you need to release the SDK and update "
-            f"the dependency. \033[0m"
+            f"\033[91m There is a mismatch between the Rasa SDK version "
+            f"({sdk.version}) and the version you want to release ({version}). "
+            f"Before you can release Rasa OSS, you need to release the SDK and "
+            f"update the dependency. \033[0m"
         )
         print()
         sys.exit(1)
 
 
-def git_existing_tags() -> Set[Text]:
-    """Return all existing tags in the local git repo."""
+def git_call(args: List[Text], **kwargs: Any) -> None:
+    """Runs a git command, raises if it fails."""
+    check_call(args, env=GIT_ENV, close_fds=False, **kwargs)
+
+
+def git_succeeds(args: List[Text], **kwargs: Any) -> bool:
+    """Runs a git command and returns whether it exited successfully."""
+    return call(args, env=GIT_ENV, close_fds=False, **kwargs) == 0
+
+
+class GitStartupInfo(NamedTuple):
+    """State of the local git repo when the release script starts."""
+
+    is_clean: bool
+    branch: Text
+
+
+@functools.lru_cache(maxsize=None)
+def git_startup_info() -> GitStartupInfo:
+    """Collects the state of the local git repo with a single subprocess.
+
+    The output consists of the exit code of `git diff-index` in the first line
+    and the current branch in the second line. The commands are chained with a
+    POSIX `sh`, so this does not work where no `sh` is available (e.g. on native
+    Windows).
+    """
+
+    diff_index = ["git", "diff-index", "--quiet", "HEAD", "--"]
+    output = check_output(
+        [
+            "sh",
+            "-c",
+            f"{' '.join(diff_index)}; echo $?; "
+            # e.g. we are in detached head state
+            "git symbolic-ref --short HEAD 2>/dev/null || echo master",
+        ],
+        env=GIT_ENV,
+        close_fds=False,
+    )
+    diff_index_exit_code, branch = output.decode().splitlines()
+
+    # `git diff-index --quiet` exits with 1 if there are changes, any other
+    # non-zero exit code means git itself failed (e.g. not a git repo)
+    if diff_index_exit_code not in ("0", "1"):
+        raise CalledProcessError(int(diff_index_exit_code), diff_index)
+
+    return GitStartupInfo(is_clean=diff_index_exit_code == "0", branch=branch)
 
-    stdout = check_output(["git", "tag"])
-    return set(stdout.decode().split("\n"))
+
+def git_tag_exists(tag: Text) -> bool:
+    """Checks whether the given tag exists in the local git repo."""
+    return git_succeeds(["git", "show-ref", "--verify", "--quiet", f"refs/tags/{tag}"])
 
 
 def git_current_branch() -> Text:
     """Returns the current git branch of the local repo."""
-
-    try:
-        output = check_output(["git", "symbolic-ref", "--short", "HEAD"])
-        return output.decode().strip()
-    except CalledProcessError:
-        # e.g. we are in detached head state
-        return "master"
+    return git_startup_info().branch
 
 
 def git_current_branch_is_master_or_release() -> bool:
@@ -228,69 +350,81 @@ def git_current_branch_is_master_or_release() -> bool:
     current_branch = git_current_branch()
     return (
         current_branch == "master"
-        or RELEASE_BRANCH_PATTERN.match(current_branch) is not None
+        or RELEASE_BRANCH_PATTERN.fullmatch(current_branch) is not None
     )
 
 
-def create_release_branch(version: Version) -> Text:
+def create_release_branch(version: "Version") -> Text:
     """Create a new branch for this release. Returns the branch name."""
 
     branch = f"{RELEASE_BRANCH_PREFIX}{version}"
-    check_call(["git", "checkout", "-b", branch])
+    git_call(["git", "checkout", "--quiet", "-b", branch], stdout=DEVNULL)
     return branch
 
 
-def create_commit(version: Version) -> None:
-    """Creates a git commit with all stashed changes."""
-    check_call(["git", "commit", "-m", f"prepared release of version {version}"])
+def stage_and_commit(paths: Iterable[Text], version: "Version") -> None:
+    """Stages the passed files in a single `git add` and commits all staged changes.
+
+    The paths are relative to the project root.
+
+    Changes staged by other tools (e.g. towncrier removing the changelog entries)
+    are part of the commit as well.
+    """
+    git_call(["git", "add", "--", *paths], cwd=str(project_root()), stdout=DEVNULL)
+    git_call(
+        ["git", "commit", "--quiet", "-m", f"prepared release of version {version}"],
+        stdout=DEVNULL,
+    )
 
 
 def push_changes() -> None:
     """Pushes the current branch to origin."""
-    check_call(["git", "push", "origin", "HEAD"])
+    git_call(["git", "push", "--quiet", "origin", "HEAD"], stdout=DEVNULL)
 
 
 def ensure_clean_git() -> None:
     """Makes sure the current working git copy is clean."""
 
-    try:
-        check_call(["git", "diff-index", "--quiet", "HEAD", "--"])
-    except CalledProcessError:
+    if not git_startup_info().is_clean:
         print("Your git is not clean. Release script can only be run from a clean git.")
         sys.exit(1)
 
 
-def parse_next_version(version: Text) -> Version:
+def parse_next_version(version: Text) -> "Version":
     """Find the next version as a proper semantic version string."""
+    if version not in NEXT_VERSION_KEYWORDS:
+        from pep440_version_utils import Version
+
+        if is_valid_version_number(version):
+            return Version(version)
+        raise Exception(f"Invalid version number '{version}'.")
+
+    current_version = get_current_parsed_version()
     if version == "major":
-        return Version(get_current_version()).next_major()
+        return current_version.next_major()
     elif version == "minor":
-        return Version(get_current_version()).next_minor()
+        return current_version.next_minor()
     elif version == "micro":
-        return Version(get_current_version()).next_micro()
+        return current_version.next_micro()
     elif version == "alpha":
-        return Version(get_current_version()).next_alpha()
-    elif version == "rc":
-        return Version(get_current_version()).next_release_candidate()
-    elif is_valid_version(version):
-        return Version(version)
+        return current_version.next_alpha()
     else:
-        raise Exception(f"Invalid version number '{cmdline_args.next_version}'.")
+        return current_version.next_release_candidate()
 
 
-def next_version(args: argparse.Namespace) -> Version:
+def next_version(args: argparse.Namespace) -> "Version":
     """Take cmdline args or ask the user for the next version and return semver."""
     return parse_next_version(args.next_version or ask_version())
 
 
-def generate_changelog(version: Version) -> None:
+def generate_changelog(version: "Version") -> None:
     """Call tonwcrier and create a changelog from all available changelog entries."""
     check_call(
         ["towncrier", "--yes", "--version", str(version)], cwd=str(project_root())
     )
 
 
-def print_done_message(branch: Text, base: Text, version: Version) -> None:
+def print_done_message(branch: Text, base: Text, version: "Version") -> None:
     """Print final information for the user on what to do next."""
 
     pull_request_url = f"{REPO_BASE_URL}/compare/{base}...{branch}?expand=1"
@@ -301,7 +435,7 @@ def print_done_message(branch: Text, base: Text, version: Version) -> None:
     print(f"Please open a PR on GitHub: {pull_request_url}")
 
 
-def print_done_message_same_branch(version: Version) -> None:
+def print_done_message_same_branch(version: "Version") -> None:
     """
     Print final information for the user in case changes
     are directly committed on this branch.
@@ -325,10 +459,13 @@ def main(args: argparse.Namespace) -> None:
     version = next_version(args)
     confirm_version(version)
 
-    validate_code_is_release_ready(version)
+    if not version.pre:
+        # prereleases can be cut before the matching Rasa SDK release exists
+        validate_code_is_release_ready(version)
 
     write_version_file(version)
     write_version_to_pyproject(version)
+    release_files = [VERSION_FILE_PATH, PYPROJECT_FILE_PATH]
 
     if not version.pre:
         # never update changelog on a prerelease version
@@ -336,7 +473,7 @@ def main(args: argparse.Namespace) -> None:
 
     # alpha workflow on feature branch when a version bump is required
     if version.is_alpha and not git_current_branch_is_master_or_release():
-        create_commit(version)
+        stage_and_commit(release_files, version)
         push_changes()
 
         print_done_message_same_branch(version)
@@ -344,7 +481,7 @@ def main(args: argparse.Namespace) -> None:
         base = git_current_branch()
         branch = create_release_branch(version)
 
-        create_commit(version)
+        stage_and_commit(release_files, version)
         push_changes()
 
         print_done_message(branch, base, version)